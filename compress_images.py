@@ -1,114 +1,356 @@
+import json
+import logging
 import os
+import queue
+import shutil
+import time
 import requests
+from logging.handlers import QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
-from multiprocessing import Pool, cpu_count, Manager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import cpu_count
+from threading import BoundedSemaphore, Event, Thread
 
 # Load API keys from the provided URL
 API_URL = 'https://raw.githubusercontent.com/arfoulidis/TAPI/main/api.txt'
+TINYPNG_API_URL = 'https://api.tinify.com/shrink'
 LOG_FILE = 'processed_files.log'
 
+# Both cases spelled out so the walker never lowercases a copy per file
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.PNG', '.JPG', '.JPEG')
+
+# On-disk cache for the key list; a 304 revalidation skips the body transfer
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tapi')
+KEY_CACHE_FILE = os.path.join(CACHE_DIR, 'api.txt')
+ETAG_CACHE_FILE = os.path.join(CACHE_DIR, 'api.etag')
+KEY_COUNT_FILE = os.path.join(CACHE_DIR, 'key_counts.json')
+
+FREE_TIER_LIMIT = 500  # compressions per key per month on the free tier
+
+# Highest Compression-Count seen per key, persisted across runs so a key
+# known to be exhausted is skipped without wasting a round-trip on it
+KEY_COUNTS = {}
+
+def current_month():
+    return time.strftime('%Y-%m')
+
+def load_key_counts():
+    # TinyPNG resets the counter each month, so entries observed in an
+    # earlier month are stale and must not keep retiring the key forever
+    KEY_COUNTS.clear()
+    if os.path.exists(KEY_COUNT_FILE):
+        with open(KEY_COUNT_FILE, 'r') as f:
+            saved = json.load(f)
+        month = current_month()
+        for key, entry in saved.items():
+            if isinstance(entry, dict) and entry.get('month') == month:
+                KEY_COUNTS[key] = entry['count']
+
+def save_key_counts():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    month = current_month()
+    with open(KEY_COUNT_FILE, 'w') as f:
+        json.dump({key: {'count': count, 'month': month}
+                   for key, count in KEY_COUNTS.items()}, f)
+
+# Shared session so every request reuses pooled keep-alive connections
+# instead of paying a fresh TCP+TLS handshake per image
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    # Back off and retry on throttling and transient server errors so a
+    # temporary 429 burst doesn't burn a perfectly good API key
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,  # retry POSTs too, shrink is idempotent enough
+        respect_retry_after_header=True,
+    ),
+))
+
+# The work is almost entirely blocking network I/O, so threads beat
+# processes: no fork/pickle cost and concurrency isn't capped at CPU count
+MAX_WORKERS = min(32, 4 * cpu_count())
+
+# Cap in-flight uploads independently of the worker count, so workers
+# busy with local resize work never starve the connection pool
+MAX_IN_FLIGHT = 32
+UPLOAD_SEMAPHORE = BoundedSemaphore(MAX_IN_FLIGHT)
+
+# Progress messages go through a queue to a single listener thread, so
+# worker threads never block on the stdout lock under high concurrency
+logger = logging.getLogger(__name__)
+
+def setup_logging():
+    log_queue = queue.Queue(-1)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
+# Shared worker state, set up once per run in process_directory (the
+# thread analogue of Pool(initializer=...)); tasks then carry only a path
+API_KEYS = []
+FAILED_KEYS = set()  # indices of dead keys; add/contains are GIL-atomic
+STOP_FLAG = Event()
+
 def load_api_keys():
-    response = requests.get(API_URL)
+    headers = {}
+    if os.path.exists(KEY_CACHE_FILE) and os.path.exists(ETAG_CACHE_FILE):
+        with open(ETAG_CACHE_FILE, 'r') as f:
+            etag = f.read().strip()
+        if etag:
+            headers['If-None-Match'] = etag
+    response = SESSION.get(API_URL, headers=headers, timeout=5)
+    if response.status_code == 304:
+        with open(KEY_CACHE_FILE, 'r') as f:
+            return f.read().strip().split('\n')
     response.raise_for_status()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(KEY_CACHE_FILE, 'w') as f:
+        f.write(response.text)
+    with open(ETAG_CACHE_FILE, 'w') as f:
+        f.write(response.headers.get('ETag', ''))
     return response.text.strip().split('\n')
 
 def load_processed_files():
+    # An exact in-memory set is already O(1) per lookup here; a Bloom
+    # filter would only trade false positives (silently skipped images)
+    # for memory we don't need to save at this scale
     if os.path.exists(LOG_FILE):
         with open(LOG_FILE, 'r') as f:
             return set(line.strip() for line in f)
     return set()
 
+# Successes are queued and appended by a single writer thread, so workers
+# never pay an open/write/close (and flush) per file on the hot path
+LOG_QUEUE = queue.Queue()
+
 def log_processed_file(file_path):
+    LOG_QUEUE.put(file_path)
+
+def log_writer():
     with open(LOG_FILE, 'a') as f:
-        f.write(file_path + '\n')
+        done = False
+        while not done:
+            items = [LOG_QUEUE.get()]
+            try:
+                while True:
+                    items.append(LOG_QUEUE.get_nowait())
+            except queue.Empty:
+                pass
+            if items[-1] is None:  # sentinel, always queued last
+                done = True
+                items.pop()
+            if items:
+                # One write per drained batch keeps syscalls off the hot path
+                f.write('\n'.join(items) + '\n')
+                f.flush()
+
+class ApiKeyError(Exception):
+    """Raised when an API key is rejected outright (revoked or out of quota)."""
 
 # Function to compress image using TinyPNG API
 def compress_image(api_key, image_path):
-    with open(image_path, 'rb') as image_file:
-        response = requests.post(
-            'https://api.tinify.com/shrink',
-            auth=('api', api_key),
-            data=image_file
-        )
-    if response.status_code == 201:
-        # Retrieve the compressed image
-        result_url = response.json()['output']['url']
-        result_response = requests.get(result_url)
-        result_response.raise_for_status()
-        with open(image_path, 'wb') as out_file:
-            out_file.write(result_response.content)
-        print(f"Compressed {image_path}")
-    else:
-        raise Exception(f"Compression failed for {image_path} with status {response.status_code}")
+    with UPLOAD_SEMAPHORE:
+        with open(image_path, 'rb') as image_file:
+            # An explicit Content-Length lets urllib3 stream the file to
+            # the socket in chunks instead of reading it all into memory
+            size = os.fstat(image_file.fileno()).st_size
+            response = SESSION.post(
+                TINYPNG_API_URL,
+                auth=('api', api_key),
+                data=image_file,
+                headers={'Content-Length': str(size)}
+            )
+        if response.status_code == 201:
+            # Retrieve the compressed image from the Location header and
+            # stream it straight to disk instead of buffering the body
+            result_url = response.headers['Location']
+            with SESSION.get(result_url, stream=True) as result_response:
+                result_response.raise_for_status()
+                with open(image_path, 'wb') as out_file:
+                    # 256KB chunks keep syscalls per body low; os.sendfile
+                    # can't help here since the bytes arrive through TLS
+                    shutil.copyfileobj(result_response.raw, out_file, length=256 * 1024)
+            count = response.headers.get('Compression-Count')
+            if count and count.isdigit():
+                KEY_COUNTS[api_key] = max(KEY_COUNTS.get(api_key, 0), int(count))
+            logger.info(f"Compressed {image_path}")
+        elif response.status_code in (401, 403):
+            raise ApiKeyError(f"API key rejected for {image_path} with status {response.status_code}")
+        else:
+            raise Exception(f"Compression failed for {image_path} with status {response.status_code}")
 
 # Function to resize image if it exceeds max dimension
 def resize_image(image_path, max_dimension=2000):
     with Image.open(image_path) as img:
+        # Image.open only parses the header, so checking .size is cheap;
+        # bail out before anything touches pixel data on the common path
         width, height = img.size
-        if max(width, height) > max_dimension:
-            if width > height:
-                new_width = max_dimension
-                new_height = int((max_dimension / width) * height)
-            else:
-                new_height = max_dimension
-                new_width = int((max_dimension / height) * width)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-            img.save(image_path)
-            print(f"Resized {image_path} to {new_width}x{new_height}")
+        if max(width, height) <= max_dimension:
+            return
+        if img.format == 'JPEG' and max(width, height) > 2 * max_dimension:
+            # Let libjpeg decode at a reduced scale (1/2, 1/4, 1/8) so
+            # LANCZOS runs over far fewer pixels than the full resolution
+            img.draft(img.mode, (max_dimension, max_dimension))
+            width, height = img.size
+        # Integer arithmetic: same truncation as the old float math in both
+        # branches, without the int/float round-trip
+        if width > height:
+            new_width = max_dimension
+            new_height = (max_dimension * height) // width
+        else:
+            new_height = max_dimension
+            new_width = (max_dimension * width) // height
+        img = img.resize((new_width, new_height), Image.LANCZOS)
+        img.save(image_path)
+        logger.info(f"Resized {image_path} to {new_width}x{new_height}")
 
-# Function to process a single image
-def process_image(args):
-    api_keys, image_path, failed_apis, stop_flag = args
+# Function to upload an image, rotating through the available API keys
+def upload_image(image_path):
     current_api_index = 0
-
-    if os.path.getsize(image_path) < 200 * 1024:  # Skip files under 200KB
-        print(f"Skipping {image_path}, size under 200KB")
-        return True
-
-    resize_image(image_path)  # Resize if needed
-
-    # Try to compress the image with available API keys
-    while current_api_index < len(api_keys):
-        if api_keys[current_api_index] in failed_apis:
+    while current_api_index < len(API_KEYS):
+        if current_api_index in FAILED_KEYS:
+            current_api_index += 1
+            continue
+        if KEY_COUNTS.get(API_KEYS[current_api_index], 0) >= FREE_TIER_LIMIT:
+            # Known-exhausted key: retire it before issuing a doomed POST
+            FAILED_KEYS.add(current_api_index)
             current_api_index += 1
             continue
         try:
-            compress_image(api_keys[current_api_index], image_path)
+            compress_image(API_KEYS[current_api_index], image_path)
             log_processed_file(image_path)
             return True
+        except ApiKeyError as e:
+            # Revoked or out-of-quota keys are dead for the whole run
+            logger.info(f"Error with API key {current_api_index}: {e}")
+            FAILED_KEYS.add(current_api_index)
         except Exception as e:
-            print(f"Error with API key {current_api_index}: {e}")
-            failed_apis.append(api_keys[current_api_index])
-            current_api_index += 1
-            if current_api_index >= len(api_keys):
-                print("No more API keys available")
-                stop_flag.value = True
-                return False
+            # Transient failure (urllib3 already retried with backoff):
+            # try the next key but keep this one in rotation
+            logger.info(f"Error with API key {current_api_index}: {e}")
+        current_api_index += 1
+
+    if len(FAILED_KEYS) >= len(API_KEYS):
+        logger.info("No more API keys available")
+        STOP_FLAG.set()
+    return False
+
+# Function to process a single image
+def process_image(image_path):
+    resize_image(image_path)  # Resize if needed
+    return upload_image(image_path)
+
+# Pipeline stages: a few CPU-bound resize workers feed a bounded queue of
+# network-bound upload workers, so resampling overlaps with the round-trips
+def resize_worker(resize_q, upload_q):
+    while True:
+        image_path = resize_q.get()
+        if image_path is None:
+            return
+        try:
+            resize_image(image_path)
+        except Exception as e:
+            logger.info(f"Error resizing {image_path}: {e}")
+            continue
+        upload_q.put(image_path)
+
+def upload_worker(upload_q):
+    while True:
+        image_path = upload_q.get()
+        if image_path is None:
+            return
+        upload_image(image_path)
+
+# Function to find eligible images, scanning directories concurrently so
+# blocking directory reads (NFS, cold cache) overlap instead of serializing
+def find_images(directory, processed_files):
+    image_paths = []
+
+    def scan(path):
+        # Walk with scandir so each entry's cached stat gives us the size
+        # for free, instead of an extra stat syscall per image later on
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith(IMAGE_EXTS):
+                        if entry.path in processed_files:
+                            logger.info(f"Skipping already processed file: {entry.path}")
+                        elif entry.stat().st_size < 200 * 1024:  # Skip files under 200KB
+                            logger.info(f"Skipping {entry.path}, size under 200KB")
+                        else:
+                            image_paths.append(entry.path)  # append is GIL-atomic
+        except OSError as e:
+            # Unreadable or vanished directories cost only their own
+            # subtree, matching os.walk's default behaviour
+            logger.info(f"Skipping unreadable directory {path}: {e}")
+        return subdirs
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pending = {executor.submit(scan, directory)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    pending.add(executor.submit(scan, subdir))
+    return image_paths
 
 # Function to process images in a directory recursively
 def process_directory(directory):
-    api_keys = load_api_keys()
+    global API_KEYS
+    API_KEYS = load_api_keys()
+    load_key_counts()
+    FAILED_KEYS.clear()
+    STOP_FLAG.clear()
     processed_files = load_processed_files()
-    image_paths = []
-    manager = Manager()
-    failed_apis = manager.list()
-    stop_flag = manager.Value('i', False)
-
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(('png', 'jpg', 'jpeg')):
-                file_path = os.path.join(root, file)
-                if file_path not in processed_files:
-                    image_paths.append((api_keys, file_path, failed_apis, stop_flag))
-                else:
-                    print(f"Skipping already processed file: {file_path}")
-
-    # Use multiprocessing to process images concurrently
-    with Pool(cpu_count()) as pool:
-        results = pool.map(process_image, image_paths)
-        if stop_flag.value:
-            print("Stopping script as all API keys have failed.")
-            return
+    image_paths = find_images(directory, processed_files)
+
+    if not image_paths:
+        return
+
+    writer = Thread(target=log_writer, daemon=True)
+    writer.start()
+
+    if len(image_paths) == 1:
+        # No point spinning up a pipeline for a single image
+        process_image(image_paths[0])
+    else:
+        # Bounded queues cap how many images sit between stages in memory
+        resize_q = queue.Queue(maxsize=2 * cpu_count())
+        upload_q = queue.Queue(maxsize=64)
+        resizers = [Thread(target=resize_worker, args=(resize_q, upload_q), daemon=True)
+                    for _ in range(cpu_count())]
+        uploaders = [Thread(target=upload_worker, args=(upload_q,), daemon=True)
+                     for _ in range(MAX_WORKERS)]
+        for t in resizers + uploaders:
+            t.start()
+        for image_path in image_paths:
+            resize_q.put(image_path)
+        for _ in resizers:
+            resize_q.put(None)
+        for t in resizers:
+            t.join()
+        for _ in uploaders:
+            upload_q.put(None)
+        for t in uploaders:
+            t.join()
+
+    LOG_QUEUE.put(None)
+    writer.join()
+    save_key_counts()
+    if STOP_FLAG.is_set():
+        logger.info("Stopping script as all API keys have failed.")
+        return
 
 if __name__ == "__main__":
     import sys
@@ -117,4 +359,8 @@ if __name__ == "__main__":
         sys.exit(1)
 
     directory = sys.argv[1]
-    process_directory(directory)
\ No newline at end of file
+    listener = setup_logging()
+    try:
+        process_directory(directory)
+    finally:
+        listener.stop()
\ No newline at end of file